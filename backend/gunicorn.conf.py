@@ -0,0 +1,44 @@
+#####################################################
+# Конфигурация gunicorn для многопроцессного режима
+# Запуск: gunicorn main:app -c gunicorn.conf.py
+#####################################################
+
+import asyncio
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('API_PORT', '8000')}"
+
+# По умолчанию один воркер на ядро
+workers = int(os.getenv("WEB_CONCURRENCY") or multiprocessing.cpu_count())
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# У каждого воркера свой пул соединений и свой контроль допуска, поэтому общий бюджет
+# соединений делим между воркерами: workers * (pool + overflow) <= DB_CONNECTION_BUDGET.
+# Воркеров не больше, чем соединений в бюджете
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", "80"))
+workers = max(min(workers, DB_CONNECTION_BUDGET), 1)
+per_worker = max(DB_CONNECTION_BUDGET // workers, 1)
+# Как и в конфигурации по умолчанию (20 + 10), треть пула - overflow
+os.environ["DB_MAX_OVERFLOW"] = str(per_worker // 3)
+os.environ["DB_POOL_SIZE"] = str(per_worker - per_worker // 3)
+
+# Каждый процесс пишет логи в свой файл app.<pid>.log
+os.environ["LOG_PER_PROCESS"] = "1"
+
+# Таймаут воркера должен покрывать самый долгий запрос к БД (QUERY_TIMEOUT_MAX)
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+
+# Создание таблиц и сидирование выполняем один раз в мастер-процессе до запуска воркеров,
+# воркеры узнают об этом по переменной окружения, унаследованной при fork
+def on_starting(server):
+    from main import init_db, get_logger
+
+    async def run():
+        await init_db(await get_logger())
+
+    asyncio.run(run())
+    os.environ["DB_INIT_DONE"] = "1"
@@ -2,16 +2,19 @@
 # Это основной файл бекенда
 #####################################################
 
+import asyncio
 from asyncio import sleep
 from contextlib import asynccontextmanager
 from pathlib import Path
 from fastapi import Request
 from fastapi import FastAPI, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
 from sqlalchemy import select, func, text
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.exc import SQLAlchemyError
-from pydantic import BaseModel, Field, field_validator
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+from pydantic import BaseModel, Field, TypeAdapter, field_validator
 from datetime import datetime
 from typing import List
 import os
@@ -24,7 +27,7 @@ import logging
 from logging.handlers import TimedRotatingFileHandler
 
 from shared.models import Base, Measurements, FDList
-from shared.config_db import engine, async_session
+from shared.config_db import engine, async_session, DB_POOL_SIZE, DB_MAX_OVERFLOW
 
 
 # Получаем конфигурацию из .env
@@ -39,7 +42,13 @@ load_dotenv()
 app = FastAPI()
 
 # Ограничиваем количество запросов в минуту
-limiter = Limiter(key_func=get_remote_address)
+# В многопроцессном режиме хранилище memory:// свое у каждого воркера,
+# для общего лимита нужно указать, например, redis://
+RATE_LIMIT = os.getenv("RATE_LIMIT", "100/minute")
+limiter = Limiter(
+    key_func=get_remote_address,
+    storage_uri=os.getenv("RATE_LIMIT_STORAGE_URI", "memory://"),
+)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
@@ -72,6 +81,145 @@ class ExceedanceResponse(BaseModel):
     frequencies: List[int]
 
 
+exceedances_adapter = TypeAdapter(List[ExceedanceResponse])
+
+
+# Таймаут запроса к БД масштабируется по ширине окна: база + N секунд за сутки окна,
+# но не больше потолка. Широкое окно не должно держать соединение из пула бесконечно
+QUERY_TIMEOUT_BASE = float(os.getenv("QUERY_TIMEOUT_BASE", "2"))
+QUERY_TIMEOUT_PER_DAY = float(os.getenv("QUERY_TIMEOUT_PER_DAY", "1"))
+QUERY_TIMEOUT_MAX = float(os.getenv("QUERY_TIMEOUT_MAX", "30"))
+# Запас клиентского дедлайна сверх серверного statement_timeout
+QUERY_TIMEOUT_GRACE = float(os.getenv("QUERY_TIMEOUT_GRACE", "1"))
+
+# Как часто проверяем, не отключился ли клиент, пока выполняется запрос
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.1"))
+
+# Сколько запросов может ждать свободного соединения, прежде чем начнем отказывать (503)
+ADMISSION_MAX_WAITING = int(os.getenv("ADMISSION_MAX_WAITING", "20"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+# Сколько запрос может ждать свободного соединения (отдельно от таймаута самого запроса)
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5"))
+# Окна шире этого считаются тяжелыми и не могут занять зарезервированные под легкие слоты
+ADMISSION_WIDE_WINDOW_DAYS = float(os.getenv("ADMISSION_WIDE_WINDOW_DAYS", "1"))
+# Сколько слотов зарезервировано под легкие запросы (по умолчанию четверть)
+ADMISSION_RESERVED_SLOTS = os.getenv("ADMISSION_RESERVED_SLOTS")
+
+# С какого числа строк сериализация ответа уходит из event loop в пул потоков
+SERIALIZE_OFFLOAD_ROWS = int(os.getenv("SERIALIZE_OFFLOAD_ROWS", "1000"))
+
+
+def window_days(params: QueryParams) -> float:
+    return (params.end_datetime - params.start_datetime).total_seconds() / 86400
+
+
+def query_timeout(params: QueryParams) -> float:
+    return min(QUERY_TIMEOUT_BASE + QUERY_TIMEOUT_PER_DAY * window_days(params), QUERY_TIMEOUT_MAX)
+
+
+class Overloaded(Exception):
+    pass
+
+
+# Контроль допуска: не больше capacity запросов одновременно держат соединение,
+# не больше max_waiting ждут своей очереди - остальным сразу отказываем.
+# Тяжелые запросы (wide) занимают не больше capacity - reserved слотов,
+# так что легким всегда остается своя полоса
+class AdmissionController:
+    def __init__(
+        self,
+        capacity: int,
+        max_waiting: int,
+        reserved: int = 0,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+    ):
+        reserved = min(reserved, max(capacity - 1, 0))
+        self.capacity = capacity
+        self.max_waiting = max_waiting
+        self.reserved = reserved
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(capacity)
+        self._wide_semaphore = asyncio.Semaphore(capacity - reserved)
+
+    @asynccontextmanager
+    async def slot(self, wide: bool = False):
+        blocked = self._semaphore.locked() or (wide and self._wide_semaphore.locked())
+        if blocked and self.waiting >= self.max_waiting:
+            raise Overloaded()
+        semaphores = [self._wide_semaphore, self._semaphore] if wide else [self._semaphore]
+        acquired = []
+        deadline = asyncio.get_running_loop().time() + self.queue_timeout
+        self.waiting += 1
+        try:
+            for semaphore in semaphores:
+                if semaphore.locked():
+                    remaining = max(deadline - asyncio.get_running_loop().time(), 0)
+                    await asyncio.wait_for(semaphore.acquire(), remaining)
+                else:
+                    # Свободный слот берем сразу, без лишних переключений event loop
+                    await semaphore.acquire()
+                acquired.append(semaphore)
+        except BaseException as e:
+            for semaphore in acquired:
+                semaphore.release()
+            if isinstance(e, asyncio.TimeoutError):
+                # Не дождались соединения - это перегрузка, а не таймаут запроса
+                raise Overloaded() from e
+            raise
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            for semaphore in acquired:
+                semaphore.release()
+
+
+ADMISSION_CAPACITY = DB_POOL_SIZE + DB_MAX_OVERFLOW
+admission = AdmissionController(
+    ADMISSION_CAPACITY,
+    ADMISSION_MAX_WAITING,
+    reserved=(
+        int(ADMISSION_RESERVED_SLOTS)
+        if ADMISSION_RESERVED_SLOTS
+        else max(ADMISSION_CAPACITY // 4, 1)
+    ),
+)
+
+
+# Выполняем корутину, пока клиент на связи: если он отключился - отменяем ее
+# (asyncpg при отмене шлет серверу cancel, соединение возвращается в пул)
+async def run_while_connected(request: Request, coro):
+    async def wait_disconnect():
+        while not await request.is_disconnected():
+            await sleep(DISCONNECT_POLL_INTERVAL)
+
+    task = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(wait_disconnect())
+    try:
+        done, _ = await asyncio.wait(
+            {task, watcher}, return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+            # Ждем фактической отмены, чтоб сессия не закрылась посреди запроса
+            await asyncio.gather(task, return_exceptions=True)
+    if task in done:
+        return task.result()
+    raise HTTPException(status_code=499, detail="Client closed request")
+
+
+# Ошибка "canceling statement due to statement timeout" в PostgreSQL
+def is_statement_timeout(e: DBAPIError) -> bool:
+    return getattr(e.orig, "sqlstate", None) == "57014"
+
+
 # Внедряем зависимость (сессию) в FastApi
 async def get_db():
     async with async_session() as session:
@@ -105,6 +253,21 @@ def configure_logging():
         full_log_path = os.path.join(log_path, log_filename)
         os.makedirs(log_path, exist_ok=True)
 
+    # В многопроцессном режиме каждый процесс пишет и ротирует свой файл,
+    # иначе воркеры затирают друг другу бэкапы при ротации
+    if os.getenv("LOG_PER_PROCESS"):
+        name, ext = os.path.splitext(full_log_path)
+        full_log_path = f"{name}.{os.getpid()}{ext}"
+
+    # Хэндлер на этот файл уже есть - второй на тот же файл ломал бы ротацию.
+    # Хэндлеры на чужие файлы (унаследованные от мастер-процесса при fork) убираем
+    full_log_path = os.path.abspath(full_log_path)
+    for existing in list(logger.handlers):
+        if isinstance(existing, TimedRotatingFileHandler):
+            if existing.baseFilename == full_log_path:
+                return logger
+            logger.removeHandler(existing)
+
     # Настраиваем хэндлер с параметрами из переменных окружения или значениями по умолчанию
     handler = TimedRotatingFileHandler(
         filename=full_log_path,
@@ -124,12 +287,11 @@ def configure_logging():
 
 # Зависимость для инъекции логгера - DI, чтоб легко тестировать и менять
 async def get_logger():
-    return configure_logging()  # Конфигурим при каждом вызове, но в реале кэшировать
+    return configure_logging()  # Хэндлер создается один раз на процесс
 
-@app.on_event("startup")
-async def startup_event():
-    logger = await get_logger()
-    logger.info("Приложение стартует")
+# Создание таблиц и сидирование. При запуске через gunicorn выполняется один раз
+# в мастер-процессе (см. gunicorn.conf.py), а не в каждом воркере
+async def init_db(logger: logging.Logger):
     max_retries = 5
     retry_interval = 5
     for i in range(max_retries):
@@ -158,6 +320,18 @@ async def startup_event():
                 raise
             logger.warning(f"Попытка {i+1} не удалась, повтор через {retry_interval} сек: {str(e)}")
             await sleep(retry_interval)
+    # Соединения не должны пережить fork в воркеры
+    await engine.dispose()
+
+
+@app.on_event("startup")
+async def startup_event():
+    logger = await get_logger()
+    logger.info("Приложение стартует")
+    if os.getenv("DB_INIT_DONE"):
+        logger.info("БД уже подготовлена мастер-процессом")
+        return
+    await init_db(logger)
 
 # Почему-то с lifespan таблицы не создаются (?)
 
@@ -208,9 +382,72 @@ async def startup_event():
 # app.lifespan = lifespan
 
 
+# Сам SELECT
+async def fetch_exceedances(db: AsyncSession, params: QueryParams, timeout: float):
+    dialect = db.bind.dialect.name
+    is_sqlite = dialect == "sqlite"
+
+    if is_sqlite:
+        agg_func = func.group_concat(Measurements.frequency)
+    else:
+        agg_func = func.array_agg(Measurements.frequency)
+        # Таймаут на стороне сервера действует только в текущей транзакции
+        await db.execute(text(f"SET LOCAL statement_timeout = {int(timeout * 1000)}"))
+
+    stmt = (
+        select(
+            Measurements.timestamp,
+            FDList.name,
+            agg_func.label("frequencies"),
+        )
+        .join(FDList, Measurements.device_id == FDList.id)
+        .where(
+            Measurements.timestamp.between(
+                params.start_datetime, params.end_datetime
+            ),
+            Measurements.rssi > params.rssi_threshold,
+        )
+        .group_by(Measurements.timestamp, FDList.name)
+        .having(func.count(Measurements.frequency) > 0)
+    )
+
+    result = await db.execute(stmt)
+    rows = result.fetchall()
+    # Завершаем транзакцию, чтоб соединение вернулось в пул еще до сериализации
+    await db.rollback()
+    return rows, is_sqlite
+
+
+# Преобразование строк результата в модели ответа
+def to_exceedances(rows, is_sqlite: bool) -> List[ExceedanceResponse]:
+    response = []
+    for row in rows:
+        if is_sqlite:
+            frequencies = (
+                [int(f) for f in row.frequencies.split(",")]
+                if row.frequencies
+                else []
+            )
+        else:
+            frequencies = row.frequencies or []
+        response.append(
+            ExceedanceResponse(
+                timestamp=row.timestamp.isoformat(),
+                device_name=row.name,
+                frequencies=frequencies,
+            )
+        )
+    return response
+
+
+# Сериализация большого результата сразу в JSON - выполняется в пуле потоков
+def serialize_exceedances(rows, is_sqlite: bool) -> bytes:
+    return exceedances_adapter.dump_json(to_exceedances(rows, is_sqlite))
+
+
 # Наш endpoint
 @app.get("/api/noise-exceedances", response_model=List[ExceedanceResponse])
-@limiter.limit("100/minute")
+@limiter.limit(RATE_LIMIT)
 async def get_exceedances(
     request: Request,
     params: QueryParams = Depends(),
@@ -219,57 +456,55 @@ async def get_exceedances(
 ):
     logger.info(f"Получен запрос: {params.model_dump()} от {request.client.host}")
 
-    try:
-        dialect = db.bind.dialect.name
-        is_sqlite = dialect == "sqlite"
+    timeout = query_timeout(params)
 
-        if is_sqlite:
-            agg_func = func.group_concat(Measurements.frequency)
-        else:
-            agg_func = func.array_agg(Measurements.frequency)
+    wide = window_days(params) > ADMISSION_WIDE_WINDOW_DAYS
 
-        stmt = (
-            select(
-                Measurements.timestamp,
-                FDList.name,
-                agg_func.label("frequencies"),
+    async def admitted_fetch():
+        # Ожидание слота ограничено отдельно, дедлайн запроса отсчитываем с момента допуска.
+        # Клиентский дедлайн чуть длиннее серверного, чтоб PostgreSQL успел отменить запрос сам
+        async with admission.slot(wide):
+            return await asyncio.wait_for(
+                fetch_exceedances(db, params, timeout), timeout + QUERY_TIMEOUT_GRACE
             )
-            .join(FDList, Measurements.device_id == FDList.id)
-            .where(
-                Measurements.timestamp.between(
-                    params.start_datetime, params.end_datetime
-                ),
-                Measurements.rssi > params.rssi_threshold,
-            )
-            .group_by(Measurements.timestamp, FDList.name)
-            .having(func.count(Measurements.frequency) > 0)
-        )
 
-        result = await db.execute(stmt)
-        rows = result.fetchall()
-
-        response = []
-        for row in rows:
-            if is_sqlite:
-                frequencies = (
-                    [int(f) for f in row.frequencies.split(",")]
-                    if row.frequencies
-                    else []
-                )
-            else:
-                frequencies = row.frequencies or []
-            response.append(
-                ExceedanceResponse(
-                    timestamp=row.timestamp.isoformat(),
-                    device_name=row.name,
-                    frequencies=frequencies,
-                )
-            )
-        logger.info(f"Запрос выполнен успешно, возвращено {len(response)} записей")
-        return response
+    try:
+        rows, is_sqlite = await run_while_connected(request, admitted_fetch())
+        logger.info(f"Запрос выполнен успешно, возвращено {len(rows)} записей")
+        if len(rows) >= SERIALIZE_OFFLOAD_ROWS:
+            # Большой результат сериализуем вне event loop, чтоб он продолжал
+            # обслуживать мелкие запросы; готовый JSON повторно не валидируется
+            content = await run_in_threadpool(serialize_exceedances, rows, is_sqlite)
+            return Response(content=content, media_type="application/json")
+        return to_exceedances(rows, is_sqlite)
+    except HTTPException as e:
+        if e.status_code == 499:
+            logger.warning("Клиент отключился, запрос к БД отменен")
+        raise
+    except Overloaded:
+        logger.warning(
+            f"Перегрузка: {admission.waiting} запросов ждут соединения, отказываем"
+        )
+        raise HTTPException(
+            status_code=503,
+            detail="Server is overloaded, retry later",
+            headers={"Retry-After": str(ADMISSION_RETRY_AFTER)},
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f"Превышен таймаут запроса ({timeout:.1f} сек)")
+        raise HTTPException(status_code=504, detail="Query timeout")
+    except DBAPIError as e:
+        if is_statement_timeout(e):
+            logger.warning(f"Превышен таймаут запроса ({timeout:.1f} сек)")
+            raise HTTPException(status_code=504, detail="Query timeout") from e
+        logger.error(f"Ошибка БД при выполнении запроса: {str(e)}")
+        raise HTTPException(status_code=503, detail="Database error") from e
+    except SQLAlchemyError as e:
+        logger.error(f"Ошибка БД при выполнении запроса: {str(e)}")
+        raise HTTPException(status_code=503, detail="Database error") from e
     except Exception as e:
         logger.error(f"Ошибка при выполнении запроса: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e)) from e
+        raise HTTPException(status_code=500, detail="Internal server error") from e
 
 
 # @app.get("/api/noise-exceedances", response_model=List[ExceedanceResponse])
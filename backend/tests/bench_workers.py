@@ -0,0 +1,185 @@
+#####################################################
+# Бенчмарк пропускной способности в многопроцессном режиме
+# Для каждого числа воркеров поднимаем gunicorn, гоняем смесь легких (5 минут)
+# и тяжелых (широкое окно) запросов, меряем req/s и p99 по успешным ответам.
+# Запуск из папки backend (нужны .env и доступная БД из DB_URL):
+#   python tests/bench_workers.py --workers 1 2 4 8 --seed 200000
+# --seed добавляет синтетические измерения, чтоб тяжелые запросы возвращали
+# тысячи строк и проходили через сериализацию в пуле потоков
+#####################################################
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+SMALL_PARAMS = {
+    "start_datetime": "2023-01-01T00:00:00Z",
+    "end_datetime": "2023-01-01T00:05:00Z",
+    "rssi_threshold": -50,
+}
+LARGE_PARAMS = {
+    "start_datetime": "2000-01-01T00:00:00Z",
+    "end_datetime": "2030-01-01T00:00:00Z",
+    "rssi_threshold": -100,
+}
+FREQUENCIES = [900000000, 2400000000, 5200000000, 5800000000]
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+# Синтетические измерения с 2023-01-02, чтоб не попадать в окно легких запросов
+async def seed_measurements(count):
+    sys.path.insert(0, str(BACKEND_DIR.parent))
+    from shared.config_db import engine
+    from shared.models import Base, FDList, Measurements
+    from sqlalchemy import insert, select
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        device_ids = (await conn.execute(select(FDList.id))).scalars().all()
+        if not device_ids:
+            raise RuntimeError("В fd_list нет устройств - сначала поднимите бекенд для сидирования")
+        start = datetime(2023, 1, 2, tzinfo=timezone.utc)
+        batch = []
+        for i in range(count):
+            slot = i // len(FREQUENCIES)
+            batch.append(
+                {
+                    "device_id": device_ids[slot % len(device_ids)],
+                    "timestamp": start + timedelta(minutes=slot),
+                    "frequency": FREQUENCIES[i % len(FREQUENCIES)],
+                    "rssi": -(i % 90) - 10,
+                }
+            )
+            if len(batch) == 10000:
+                await conn.execute(insert(Measurements), batch)
+                batch = []
+        if batch:
+            await conn.execute(insert(Measurements), batch)
+    await engine.dispose()
+
+
+def start_server(workers, port, log_file):
+    env = dict(
+        os.environ,
+        WEB_CONCURRENCY=str(workers),
+        API_PORT=str(port),
+        # Лимит запросов мешает замеру пропускной способности
+        RATE_LIMIT="1000000/minute",
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "main:app", "-c", "gunicorn.conf.py"],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=log_file,
+        stderr=subprocess.STDOUT,
+    )
+
+
+async def wait_ready(client, url, server, log_path, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(
+                f"gunicorn завершился с кодом {server.returncode}:\n{log_path.read_text()}"
+            )
+        try:
+            response = await client.get(url, params=SMALL_PARAMS)
+            if response.status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError(f"Сервер не поднялся за {timeout} сек:\n{log_path.read_text()}")
+
+
+async def run_load(client, url, small, large, duration):
+    deadline = time.monotonic() + duration
+    results = {
+        name: {"latencies": [], "statuses": Counter()} for name in ("small", "large")
+    }
+
+    async def worker(name, params):
+        stats = results[name]
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            try:
+                response = await client.get(url, params=params)
+                stats["statuses"][response.status_code] += 1
+            except httpx.HTTPError as e:
+                stats["statuses"][type(e).__name__] += 1
+                continue
+            # Отказы (503, 429) не считаются обслуженными запросами
+            if response.status_code == 200:
+                stats["latencies"].append(time.monotonic() - started)
+
+    await asyncio.gather(
+        *(worker("small", SMALL_PARAMS) for _ in range(small)),
+        *(worker("large", LARGE_PARAMS) for _ in range(large)),
+    )
+    return results
+
+
+def report(workers, name, stats, duration):
+    latencies = stats["latencies"]
+    print(
+        f"workers={workers} {name}: {len(latencies) / duration:.1f} req/s (200), "
+        f"p50={percentile(latencies, 50) * 1000:.0f} мс, "
+        f"p99={percentile(latencies, 99) * 1000:.0f} мс, "
+        f"статусы={dict(stats['statuses'])}"
+    )
+
+
+async def bench(workers, args):
+    url = f"http://127.0.0.1:{args.port}/api/noise-exceedances"
+    log_path = Path(tempfile.gettempdir()) / f"bench_gunicorn_{workers}.log"
+    with open(log_path, "w") as log_file:
+        server = start_server(workers, args.port, log_file)
+        try:
+            limits = httpx.Limits(max_connections=args.small + args.large)
+            async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+                await wait_ready(client, url, server, log_path)
+                # Прогрев
+                await run_load(client, url, args.small, args.large, 1)
+                results = await run_load(
+                    client, url, args.small, args.large, args.duration
+                )
+        finally:
+            server.terminate()
+            server.wait()
+
+    report(workers, "легкие", results["small"], args.duration)
+    report(workers, "тяжелые", results["large"], args.duration)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк gunicorn с разным числом воркеров")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--duration", type=float, default=15, help="Длительность замера, сек")
+    parser.add_argument("--small", type=int, default=48, help="Клиентов с легкими запросами")
+    parser.add_argument("--large", type=int, default=16, help="Клиентов с тяжелыми запросами")
+    parser.add_argument("--timeout", type=float, default=60, help="Таймаут HTTP-клиента, сек")
+    parser.add_argument("--seed", type=int, default=0, help="Добавить N синтетических измерений")
+    args = parser.parse_args()
+    if args.seed:
+        asyncio.run(seed_measurements(args.seed))
+    for n in args.workers:
+        asyncio.run(bench(n, args))
@@ -0,0 +1,91 @@
+#####################################################
+# Нагрузочный тест эндпоинта превышений
+# Параллельно гоняем "тяжелые" запросы (широкое окно) и "легкие" (5 минут),
+# смотрим, что p99 легких остается ограниченным, пока тяжелые выполняются.
+# Перцентили считаются только по успешным ответам (200), отказы выводятся отдельно.
+# Все запросы идут с одного IP, поэтому перед замером поднимите лимит запросов
+# в backend/.env (или в environment сервиса backend) и перезапустите стек:
+#   RATE_LIMIT=1000000/minute
+# Запуск против поднятого стека:
+#   python backend/tests/load_exceedances.py --url http://localhost/api/noise-exceedances
+#####################################################
+
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+import httpx
+
+SMALL_PARAMS = {
+    "start_datetime": "2023-01-01T00:00:00Z",
+    "end_datetime": "2023-01-01T00:05:00Z",
+    "rssi_threshold": -50,
+}
+LARGE_PARAMS = {
+    "start_datetime": "2000-01-01T00:00:00Z",
+    "end_datetime": "2030-01-01T00:00:00Z",
+    "rssi_threshold": -100,
+}
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def worker(client, url, params, deadline, latencies, statuses):
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        try:
+            response = await client.get(url, params=params)
+            statuses[response.status_code] += 1
+        except httpx.HTTPError as e:
+            statuses[type(e).__name__] += 1
+            continue
+        # Мгновенные отказы (429, 503) занизили бы перцентили - учитываем только 200
+        if response.status_code == 200:
+            latencies.append(time.monotonic() - started)
+
+
+def report(name, latencies, statuses):
+    print(
+        f"{name}: {len(latencies)} успешных, "
+        f"p50={percentile(latencies, 50) * 1000:.0f} мс, "
+        f"p95={percentile(latencies, 95) * 1000:.0f} мс, "
+        f"p99={percentile(latencies, 99) * 1000:.0f} мс, "
+        f"статусы={dict(statuses)}"
+    )
+
+
+async def main(args):
+    deadline = time.monotonic() + args.duration
+    small_latencies, large_latencies = [], []
+    small_statuses, large_statuses = Counter(), Counter()
+
+    limits = httpx.Limits(max_connections=args.small + args.large)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        tasks = [
+            worker(client, args.url, LARGE_PARAMS, deadline, large_latencies, large_statuses)
+            for _ in range(args.large)
+        ] + [
+            worker(client, args.url, SMALL_PARAMS, deadline, small_latencies, small_statuses)
+            for _ in range(args.small)
+        ]
+        await asyncio.gather(*tasks)
+
+    report("Легкие (5 мин)", small_latencies, small_statuses)
+    report("Тяжелые (30 лет)", large_latencies, large_statuses)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест /api/noise-exceedances")
+    parser.add_argument("--url", default="http://localhost/api/noise-exceedances")
+    parser.add_argument("--duration", type=float, default=30, help="Длительность, сек")
+    parser.add_argument("--small", type=int, default=20, help="Клиентов с легкими запросами")
+    parser.add_argument("--large", type=int, default=40, help="Клиентов с тяжелыми запросами")
+    parser.add_argument("--timeout", type=float, default=60, help="Таймаут HTTP-клиента, сек")
+    asyncio.run(main(parser.parse_args()))
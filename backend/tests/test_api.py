@@ -2,9 +2,11 @@
 # Тесты бекенда
 #####################################################
 
+import asyncio
 import pytest
 from fastapi.testclient import TestClient
-from main import app, get_db
+import main
+from main import app, get_db, query_timeout, QueryParams, AdmissionController, Overloaded
 from shared.models import Base, FDList, Measurements
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
@@ -278,3 +280,206 @@ def test_get_exceedances_multiple_frequencies():
 
     # Проверяем частоты независимо от порядка
     assert sorted(data[0]["frequencies"]) == [2400000000, 5800000000]
+
+
+# Тест масштабирования таймаута по ширине окна
+def test_query_timeout_scales_with_window():
+    small = QueryParams(
+        start_datetime="2023-01-01T00:00:00Z",
+        end_datetime="2023-01-01T00:05:00Z",
+        rssi_threshold=-50,
+    )
+    week = QueryParams(
+        start_datetime="2023-01-01T00:00:00Z",
+        end_datetime="2023-01-08T00:00:00Z",
+        rssi_threshold=-50,
+    )
+    huge = QueryParams(
+        start_datetime="2000-01-01T00:00:00Z",
+        end_datetime="2023-01-01T00:00:00Z",
+        rssi_threshold=-50,
+    )
+    assert main.QUERY_TIMEOUT_BASE <= query_timeout(small) < query_timeout(week)
+    assert query_timeout(huge) == main.QUERY_TIMEOUT_MAX
+
+
+# Тест контроля допуска: при заполненной очереди новые запросы сразу отклоняются
+def test_admission_controller_rejects_when_queue_full():
+    async def scenario():
+        controller = AdmissionController(capacity=1, max_waiting=1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with controller.slot():
+                await release.wait()
+
+        holder = asyncio.ensure_future(hold())
+        waiter = asyncio.ensure_future(hold())
+        try:
+            await asyncio.sleep(0)
+            assert controller.active == 1
+            assert controller.waiting == 1
+
+            with pytest.raises(Overloaded):
+                async with controller.slot():
+                    pass
+        finally:
+            release.set()
+            await asyncio.gather(holder, waiter)
+        assert controller.active == 0
+        assert controller.waiting == 0
+
+    asyncio.run(scenario())
+
+
+# Тест резерва: тяжелые запросы не занимают слоты легких, а легкие не ждут дольше queue_timeout
+def test_admission_controller_reserves_slots_for_narrow_queries():
+    async def scenario():
+        controller = AdmissionController(
+            capacity=2, max_waiting=5, reserved=1, queue_timeout=0.1
+        )
+        release = asyncio.Event()
+
+        async def hold(wide):
+            async with controller.slot(wide):
+                await release.wait()
+
+        wide_holder = asyncio.ensure_future(hold(True))
+        narrow_holder = None
+        try:
+            await asyncio.sleep(0)
+            assert controller.active == 1
+
+            # Второй тяжелый не помещается в свою полосу и получает отказ по таймауту ожидания
+            with pytest.raises(Overloaded):
+                async with controller.slot(True):
+                    pass
+
+            # Легкий занимает зарезервированный слот
+            narrow_holder = asyncio.ensure_future(hold(False))
+            await asyncio.sleep(0)
+            assert controller.active == 2
+        finally:
+            release.set()
+            await asyncio.gather(wide_holder, *filter(None, [narrow_holder]))
+        assert controller.active == 0
+        assert controller.waiting == 0
+
+    asyncio.run(scenario())
+
+
+# Тест ответа 503 с Retry-After при перегрузке
+def test_get_exceedances_overloaded(monkeypatch):
+    monkeypatch.setattr(main, "admission", AdmissionController(capacity=0, max_waiting=0))
+    response = client.get(
+        "/api/noise-exceedances?start_datetime=2023-01-01T00:00:00Z&end_datetime=2023-01-01T00:05:00Z&rssi_threshold=-50"
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(main.ADMISSION_RETRY_AFTER)
+
+
+# Тест ответа 504, если запрос не уложился в таймаут
+def test_get_exceedances_timeout(monkeypatch):
+    async def slow_fetch(db, params, timeout):
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(main, "fetch_exceedances", slow_fetch)
+    monkeypatch.setattr(main, "query_timeout", lambda params: 0.1)
+    monkeypatch.setattr(main, "QUERY_TIMEOUT_GRACE", 0)
+    response = client.get(
+        "/api/noise-exceedances?start_datetime=2023-01-01T00:00:00Z&end_datetime=2023-01-01T00:05:00Z&rssi_threshold=-50"
+    )
+    assert response.status_code == 504
+    assert response.json()["detail"] == "Query timeout"
+
+
+# Тест отмены запроса к БД, когда клиент отключился
+def test_get_exceedances_cancelled_on_disconnect(monkeypatch):
+    controller = AdmissionController(capacity=1, max_waiting=1)
+    started = []
+    cancelled = []
+
+    async def slow_fetch(db, params, timeout):
+        started.append(True)
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(controller.active)
+            raise
+
+    # Клиент "отключается", как только запрос дошел до БД
+    async def is_disconnected(self):
+        return bool(started)
+
+    monkeypatch.setattr(main, "admission", controller)
+    monkeypatch.setattr(main, "fetch_exceedances", slow_fetch)
+    monkeypatch.setattr(main.Request, "is_disconnected", is_disconnected)
+    monkeypatch.setattr(main, "DISCONNECT_POLL_INTERVAL", 0.01)
+    response = client.get(
+        "/api/noise-exceedances?start_datetime=2023-01-01T00:00:00Z&end_datetime=2023-01-01T00:05:00Z&rssi_threshold=-50"
+    )
+    assert response.status_code == 499
+    # Запрос отменен, пока держал слот, и слот освобожден
+    assert cancelled == [1]
+    assert controller.active == 0
+    assert controller.waiting == 0
+
+
+# Тест того, что ожидание слота не съедает таймаут запроса: долгая очередь - это 503, а не 504
+def test_get_exceedances_queue_timeout_is_overload(monkeypatch):
+    controller = AdmissionController(capacity=0, max_waiting=1, queue_timeout=0.05)
+    monkeypatch.setattr(main, "admission", controller)
+    response = client.get(
+        "/api/noise-exceedances?start_datetime=2023-01-01T00:00:00Z&end_datetime=2023-01-01T00:05:00Z&rssi_threshold=-50"
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(main.ADMISSION_RETRY_AFTER)
+    assert controller.waiting == 0
+
+
+# Тест того, что текст внутренней ошибки не уходит клиенту
+def test_get_exceedances_hides_internal_error(monkeypatch):
+    async def broken_fetch(db, params, timeout):
+        raise RuntimeError("secret internals")
+
+    monkeypatch.setattr(main, "fetch_exceedances", broken_fetch)
+    response = client.get(
+        "/api/noise-exceedances?start_datetime=2023-01-01T00:00:00Z&end_datetime=2023-01-01T00:05:00Z&rssi_threshold=-50"
+    )
+    assert response.status_code == 500
+    assert "secret internals" not in response.text
+
+
+# Тест сериализации большого результата в пуле потоков - ответ тот же, что и обычный
+def test_get_exceedances_offloaded_serialization(monkeypatch):
+    url = "/api/noise-exceedances?start_datetime=2023-01-01T00:00:00Z&end_datetime=2023-01-01T00:05:00Z&rssi_threshold=-50"
+    expected = client.get(url).json()
+
+    monkeypatch.setattr(main, "SERIALIZE_OFFLOAD_ROWS", 1)
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+
+    def normalize(data):
+        for item in data:
+            item["frequencies"] = sorted(item["frequencies"])
+        return sorted(data, key=lambda x: (x["timestamp"], x["device_name"]))
+
+    assert normalize(response.json()) == normalize(expected)
+
+
+# Тест того, что воркер не повторяет подготовку БД, уже выполненную мастер-процессом
+def test_startup_skips_init_when_done(monkeypatch):
+    calls = []
+
+    async def fake_init_db(logger):
+        calls.append(logger)
+
+    monkeypatch.setattr(main, "init_db", fake_init_db)
+    monkeypatch.setenv("DB_INIT_DONE", "1")
+    asyncio.run(main.startup_event())
+    assert calls == []
+
+    monkeypatch.delenv("DB_INIT_DONE")
+    asyncio.run(main.startup_event())
+    assert len(calls) == 1
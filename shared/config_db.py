@@ -7,5 +7,11 @@ load_dotenv()
 
 DB_URL = os.getenv("DB_URL")
 
-engine = create_async_engine(DB_URL, echo=True, pool_size=20, max_overflow=10)
+# Параметры пула соединений (их же использует контроль допуска в бекенде)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+
+engine = create_async_engine(
+    DB_URL, echo=True, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW
+)
 async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)